@@ -0,0 +1,79 @@
+import unittest
+
+from weir import cache
+
+class Clock(object):
+	def __init__(self):
+		self.now = 100.0
+
+	def __call__(self):
+		return self.now
+
+class PropCacheTest(unittest.TestCase):
+	def setUp(self):
+		self._clock = cache._clock
+		self.clock = cache._clock = Clock()
+		self.cache = cache.PropCache(ttl=1)
+
+	def tearDown(self):
+		cache._clock = self._clock
+
+	def test_ttl(self):
+		self.cache.put(('pool/fs', 'used'), '1024')
+		self.clock.now += 0.5
+		self.assertEqual(self.cache.getprop('pool/fs', 'used'), '1024')
+		self.clock.now += 0.5
+		self.assertEqual(self.cache.getprop('pool/fs', 'used'), None)
+
+	def test_put_rows(self):
+		rows = [{'name': 'pool/fs', 'property': 'used', 'value': '1024'}]
+		self.cache.put_rows(('pool/fs', 'all'), rows)
+		self.assertEqual(self.cache.get(('pool/fs', 'all')), rows)
+		self.assertEqual(self.cache.getprop('pool/fs', 'used'), rows[0])
+
+	def test_invalidate_related(self):
+		for name in ('pool', 'pool/fs', 'pool/fs/child', 'pool/fs@snap',
+				'pool/fsx', 'pool/other', 'other'):
+			self.cache.put((name, 'used'), '1024')
+		self.cache.invalidate('pool/fs@snap2')
+		self.assertEqual(
+			sorted(key[0] for key in self.cache._entries),
+			['other', 'pool/fsx', 'pool/other'])
+
+	def test_invalidate_all(self):
+		self.cache.put(('pool/fs', 'used'), '1024')
+		self.cache.invalidate()
+		self.assertEqual(self.cache.getprop('pool/fs', 'used'), None)
+
+	def test_generation(self):
+		generation = self.cache.generation
+		self.cache.invalidate('pool/other')
+		self.cache.put(('pool/fs', 'used'), '1024', generation)
+		self.assertEqual(self.cache.getprop('pool/fs', 'used'), None)
+		self.cache.put_rows(('pool/fs', 'all'), [], generation)
+		self.assertEqual(self.cache.get(('pool/fs', 'all')), None)
+
+		self.cache.put(('pool/fs', 'used'), '1024', self.cache.generation)
+		self.assertEqual(self.cache.getprop('pool/fs', 'used'), '1024')
+
+	def test_session(self):
+		with self.cache.session():
+			self.cache.put(('pool/fs', 'used'), '1024')
+			self.clock.now += 10
+			self.assertEqual(self.cache.getprop('pool/fs', 'used'), '1024')
+		self.assertEqual(self.cache.getprop('pool/fs', 'used'), None)
+
+	def test_session_expired(self):
+		self.cache.put(('pool/fs', 'used'), '1024')
+		self.clock.now += 10
+		with self.cache.session():
+			self.assertEqual(self.cache.getprop('pool/fs', 'used'), None)
+
+	def test_session_invalidate(self):
+		with self.cache.session():
+			self.cache.put(('pool/fs', 'used'), '1024')
+			self.cache.invalidate('pool/fs/child')
+			self.assertEqual(self.cache.getprop('pool/fs', 'used'), None)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,116 @@
+import errno
+import unittest
+
+from weir import _lzc, process
+
+class ZFSError(Exception):
+	def __init__(self, errno=None, name=None, errors=None):
+		super(ZFSError, self).__init__(errno, name)
+		self.errno = errno
+		self.name = name
+		self.errors = errors
+
+# Stand-in for the libzfs_core module, failing each call with the given
+# error or returning the given missing snapshots
+class FakeLibZFSCore(object):
+	class exceptions(object):
+		ZFSError = ZFSError
+
+	def __init__(self, error=None, missing=()):
+		self.error = error
+		self.missing = list(missing)
+		self.calls = []
+
+	def call(self, name, arg):
+		self.calls.append((name, arg))
+		if self.error is not None:
+			raise self.error
+		return self.missing
+
+	def lzc_snapshot(self, snaps):
+		return self.call('snapshot', snaps)
+
+	def lzc_hold(self, holds):
+		return self.call('hold', holds)
+
+	def lzc_release(self, holds):
+		return self.call('release', holds)
+
+class LZCTest(unittest.TestCase):
+	def setUp(self):
+		self.libzfs_core = _lzc.libzfs_core
+
+	def tearDown(self):
+		_lzc.libzfs_core = self.libzfs_core
+
+	def fake(self, *args, **kwargs):
+		_lzc.libzfs_core = FakeLibZFSCore(*args, **kwargs)
+		return _lzc.libzfs_core
+
+	def assertError(self, Error, name, func, *args):
+		try:
+			func(*args)
+		except Error as e:
+			self.assertEqual(e.filename, name)
+		else:
+			self.fail('{0} not raised'.format(Error.__name__))
+
+	def test_snapshot(self):
+		lzc = self.fake()
+		_lzc.snapshot(['pool/fs@snap'])
+		self.assertEqual(lzc.calls, [('snapshot', [b'pool/fs@snap'])])
+
+	def test_snapshot_errors(self):
+		for code, Error in (
+				(errno.EEXIST, process.DatasetExistsError),
+				(errno.ENOENT, process.DatasetNotFoundError),
+				(errno.EBUSY, process.DatasetBusyError)):
+			self.fake(ZFSError(errors=[ZFSError(code, b'pool/fs@snap')]))
+			self.assertError(Error, 'pool/fs@snap',
+				_lzc.snapshot, ['pool/fs@snap'])
+
+	def test_snapshot_unknown_error(self):
+		error = ZFSError(errno.EIO, b'pool/fs@snap')
+		self.fake(error)
+		try:
+			_lzc.snapshot(['pool/fs@snap'])
+		except ZFSError as e:
+			self.assertTrue(e is error)
+		else:
+			self.fail('ZFSError not raised')
+
+	def test_hold_errors(self):
+		for code, Error in (
+				(errno.EEXIST, process.HoldTagExistsError),
+				(errno.ENOENT, process.DatasetNotFoundError)):
+			self.fake(ZFSError(errors=[ZFSError(code, b'pool/fs@snap')]))
+			self.assertError(Error, 'pool/fs@snap',
+				_lzc.hold, 'keep', ['pool/fs@snap'])
+
+	def test_hold_missing(self):
+		lzc = self.fake(missing=[b'pool/fs@snap'])
+		self.assertError(process.DatasetNotFoundError, 'pool/fs@snap',
+			_lzc.hold, 'keep', ['pool/fs@snap'])
+		self.assertEqual(lzc.calls, [('hold', {b'pool/fs@snap': b'keep'})])
+
+	def test_pools(self):
+		lzc = self.fake()
+		paths = ['tank/a@s', 'rpool/b@s', 'tank/c@s']
+		_lzc.hold('keep', paths)
+		_lzc.release('keep', paths)
+		self.assertEqual(lzc.calls, [
+			('hold', {b'tank/a@s': b'keep', b'tank/c@s': b'keep'}),
+			('hold', {b'rpool/b@s': b'keep'}),
+			('release', {b'tank/a@s': [b'keep'], b'tank/c@s': [b'keep']}),
+			('release', {b'rpool/b@s': [b'keep']})])
+
+	def test_release_errors(self):
+		for code, Error in (
+				(errno.ESRCH, process.HoldTagNotFoundError),
+				(errno.ENOENT, process.DatasetNotFoundError)):
+			self.fake(ZFSError(errors=[ZFSError(code, b'pool/fs@snap')]))
+			self.assertError(Error, 'pool/fs@snap',
+				_lzc.release, 'keep', ['pool/fs@snap'])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,151 @@
+import logging
+import os
+import signal
+import unittest
+
+from weir import process
+
+class Handler(logging.Handler):
+	def __init__(self):
+		logging.Handler.__init__(self)
+		self.messages = []
+
+	def emit(self, record):
+		self.messages.append(record.getMessage())
+
+class CheckReturncodeTest(unittest.TestCase):
+	def check(self, stderr, returncode=1):
+		process.CompletedProcess(['zfs'], returncode, None,
+			stderr).check_returncode()
+
+	def assertError(self, Error, dataset, stderr, returncode=1):
+		try:
+			self.check(stderr, returncode)
+		except Error as e:
+			self.assertTrue(type(e) is Error)
+			self.assertEqual(e.filename, dataset)
+		else:
+			self.fail('{0} not raised'.format(Error.__name__))
+
+	def test_known_errors(self):
+		for Error in (
+				process.DatasetNotFoundError,
+				process.DatasetExistsError,
+				process.DatasetBusyError,
+				process.HoldTagNotFoundError,
+				process.HoldTagExistsError):
+			self.assertError(Error, 'pool/fs',
+				"cannot open 'pool/fs': " + Error.strerror)
+
+	def test_multi_word_action(self):
+		self.assertError(process.DatasetExistsError, 'pool/fs@snap',
+			"cannot create snapshot 'pool/fs@snap': dataset already exists")
+		self.assertError(process.DatasetBusyError, 'pool/fs',
+			"cannot unmount and destroy 'pool/fs': dataset is busy")
+
+	def test_unquoted(self):
+		self.assertError(process.DatasetNotFoundError, 'pool/fs',
+			'cannot open pool/fs: dataset does not exist')
+
+	def test_spaces(self):
+		self.assertError(process.DatasetNotFoundError, 'pool/my fs',
+			"cannot open 'pool/my fs': dataset does not exist")
+		self.assertError(process.HoldTagExistsError, 'pool/a: b@snap',
+			"cannot hold 'pool/a: b@snap': tag already exists on this dataset")
+
+	def test_success(self):
+		self.check(None, 0)
+		self.check('', 0)
+
+	def test_unknown(self):
+		for stderr in (None, '', 'cannot open', "cannot 'pool/fs'",
+				"cannot open 'pool/fs': permission denied",
+				'internal error: dataset does not exist'):
+			self.assertRaises(process.CalledProcessError, self.check, stderr)
+		self.assertRaises(process.CalledProcessError, self.check,
+			"cannot open 'pool/fs': dataset does not exist", 2)
+
+	def test_stderr_kept(self):
+		try:
+			self.check('cannot open: permission denied')
+		except process.CalledProcessError as e:
+			self.assertEqual(e.stderr, 'cannot open: permission denied')
+		else:
+			self.fail('CalledProcessError not raised')
+
+class StderrLogTest(unittest.TestCase):
+	def setUp(self):
+		self.handler = Handler()
+		self.level = process.log.level
+		process.log.addHandler(self.handler)
+		process.log.setLevel(logging.DEBUG)
+
+	def tearDown(self):
+		process.log.removeHandler(self.handler)
+		process.log.setLevel(self.level)
+
+	def test_progress(self):
+		self.assertTrue(process._progress('12:34:56\t1234567\tpool/fs@snap'))
+		self.assertTrue(process._progress('12:34:56   1.23M   pool/fs@snap'))
+		self.assertFalse(process._progress('full\tpool/fs@snap\t1234567'))
+		self.assertFalse(process._progress("cannot open 'pool/fs': "
+			"dataset does not exist"))
+
+	def test_rate_limit_progress_only(self):
+		stderr = process._StderrLog(None)
+		stderr.interval = 60
+		lines = [
+			'full\tpool/fs@snap\t1234567',
+			'size\t1234567',
+			'12:34:56\t1\tpool/fs@snap',
+			'12:34:56\t2\tpool/fs@snap',
+			'12:34:56\t3\tpool/fs@snap',
+			'12:34:57\t4\tpool/fs@snap',
+			'received 1.18M stream in 1 seconds',
+			'12:34:58\t5\tpool/fs@snap',
+			'12:34:58\t6\tpool/fs@snap',
+		]
+		for line in lines:
+			stderr.line(line)
+		stderr.finish()
+		self.assertEqual(self.handler.messages, [
+			'full\tpool/fs@snap\t1234567',
+			'size\t1234567',
+			'12:34:56\t1\tpool/fs@snap',
+			'12:34:57\t4\tpool/fs@snap',
+			'received 1.18M stream in 1 seconds',
+			'12:34:58\t6\tpool/fs@snap',
+		])
+		self.assertEqual(stderr.read(), lines[-1])
+
+class PoolTest(unittest.TestCase):
+	def test_call_async_nested(self):
+		# functions run in the background map inline rather than waiting
+		# on the pool they are running in
+		def worker():
+			return process._worker.active, process.pool_map(abs, [-1, -2])
+		result = process.call_async(worker)
+		self.assertEqual(result.get(10), (True, [1, 2]))
+
+class StderrReactorTest(unittest.TestCase):
+	@unittest.skipUnless(hasattr(os, 'fork') and process._reactor is not None,
+		'needs fork() and the stderr reactor')
+	def test_fork(self):
+		# start the reactor in this process
+		self.assertEqual(list(process.check_output_iter(['echo', 'a'])),
+			[['a']])
+
+		pid = os.fork()
+		if pid == 0:
+			# the child must never return into the test runner
+			ok = False
+			try:
+				signal.alarm(10)
+				ok = list(process.check_output_iter(['echo', 'b'])) == [['b']]
+			finally:
+				os._exit(0 if ok else 1)
+		_, status = os.waitpid(pid, 0)
+		self.assertEqual(status, 0)
+
+if __name__ == '__main__':
+	unittest.main()
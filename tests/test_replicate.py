@@ -0,0 +1,72 @@
+import signal
+import unittest
+
+from weir import process, replicate, zfs
+
+# Stand-in for the stream from zfs send, failing on close as given
+class Stream(object):
+	def __init__(self, error=None):
+		self.error = error
+		self.closed = False
+
+	def close(self):
+		self.closed = True
+		if self.error is not None:
+			raise self.error
+
+class Snapshot(zfs.ZFSSnapshot):
+	__slots__ = ('stream',)
+
+	def send(self, base=None):
+		return self.stream
+
+def send_error(returncode, stderr):
+	e = process.CalledProcessError(returncode, ['zfs', 'send'])
+	e.stderr = stderr
+	return e
+
+class ReplicateTest(unittest.TestCase):
+	def setUp(self):
+		self.receive = zfs.receive
+		zfs.receive = self.fail_receive
+
+	def tearDown(self):
+		zfs.receive = self.receive
+
+	def fail_receive(self, target, file=None):
+		raise process.DatasetExistsError(target)
+
+	def replicate(self, error=None):
+		snapshot = Snapshot('pool/fs@snap')
+		snapshot.stream = Stream(error)
+		try:
+			replicate.replicate(snapshot, 'backup/fs')
+		finally:
+			self.assertTrue(snapshot.stream.closed)
+
+	def test_receive_error(self):
+		self.assertRaises(process.DatasetExistsError, self.replicate)
+
+	def test_receive_error_send_sigpipe(self):
+		self.assertRaises(process.DatasetExistsError,
+			self.replicate, send_error(-signal.SIGPIPE, None))
+
+	def test_receive_error_send_broken_pipe(self):
+		self.assertRaises(process.DatasetExistsError, self.replicate,
+			send_error(1, "warning: cannot send 'pool/fs@snap': Broken pipe"))
+
+	def test_send_error(self):
+		e = send_error(1, "cannot open 'pool/fs@snap': I/O error")
+		try:
+			self.replicate(e)
+		except process.CalledProcessError as raised:
+			self.assertTrue(raised is e)
+		else:
+			self.fail('send error not raised')
+
+	def test_success(self):
+		zfs.receive = lambda target, file=None: None
+		self.replicate()
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,258 @@
+import io
+import unittest
+
+from weir import cache, process, zfs
+
+# Runs zfs commands against a fixed output rather than running them
+class ZFSTestCase(unittest.TestCase):
+	output = ()
+	error = None
+
+	def setUp(self):
+		self.cmds = []
+		self.check_output_iter = process.check_output_iter
+		process.check_output_iter = self.fake_output_iter
+		self.check_call = process.check_call
+		process.check_call = self.fake_call
+		zfs.clear_cache()
+
+	def tearDown(self):
+		process.check_output_iter = self.check_output_iter
+		process.check_call = self.check_call
+		zfs.clear_cache()
+
+	def fake_call(self, cmd, **kwargs):
+		self.cmds.append(cmd)
+		return 0
+
+	def fake_output_iter(self, cmd, **kwargs):
+		self.cmds.append(cmd)
+		if self.error is not None:
+			raise self.error
+		return iter(self.output)
+
+class FindpropsTest(ZFSTestCase):
+	output = [['pool/fs'], ['pool/fs@snap']]
+
+	def test_names_all_types(self):
+		rows = zfs.findprops('pool/fs', props=['name'])
+		self.assertEqual(self.cmds,
+			[['zfs', 'list', '-H', '-r', '-t', 'all', '-o', 'name', 'pool/fs']])
+		self.assertEqual([row.name for row in rows], ['pool/fs', 'pool/fs@snap'])
+
+	def test_names_types(self):
+		zfs.findprops('pool/fs', props=['name'], types=['snapshot'])
+		self.assertEqual(self.cmds, [['zfs', 'list', '-H', '-r',
+			'-t', 'snapshot', '-o', 'name', 'pool/fs']])
+
+# zfs without zfs get -t, where zfs get exits with a usage error for
+# -t or an invalid property
+class GetTypesTest(ZFSTestCase):
+	def setUp(self):
+		super(GetTypesTest, self).setUp()
+		zfs._get_types.clear()
+
+	def tearDown(self):
+		super(GetTypesTest, self).tearDown()
+		zfs._get_types.clear()
+
+	# as process.check_output_iter(), fail only once iterated
+	def fake_output_iter(self, cmd, **kwargs):
+		self.cmds.append(cmd)
+		if cmd[1] == 'list':
+			yield ['pool/fs']
+		elif '-t' in cmd or 'usedd' in cmd:
+			raise process.CalledProcessError(2, cmd)
+		else:
+			yield ['pool/fs', 'used', '1024', '-']
+
+	def test_unsupported(self):
+		rows = zfs.findprops('pool/fs', props=['used'], types=['filesystem'])
+		self.assertEqual([row.value for row in rows], ['1024'])
+		self.assertEqual(zfs._get_types, {None: False})
+		self.assertEqual(len(self.cmds), 3)
+
+		zfs.clear_cache()
+		zfs.findprops('pool/fs', props=['used'], types=['filesystem'])
+		self.assertEqual(len(self.cmds), 5)
+
+	def test_invalid_property(self):
+		zfs._get_types[None] = True
+		self.assertRaises(process.CalledProcessError, zfs.findprops,
+			'pool/fs', props=['usedd'], types=['filesystem'])
+		self.assertEqual(zfs._get_types, {None: True})
+
+		zfs._get_types.clear()
+		self.assertRaises(process.CalledProcessError, zfs.findprops,
+			'pool/fs', props=['usedd'], types=['filesystem'])
+		self.assertEqual(zfs._get_types, {})
+
+class OpenTest(ZFSTestCase):
+	output = [['pool/fs', 'type', 'filesystem', '-']]
+
+	def test_reuse(self):
+		dataset = zfs.open('pool/fs')
+		self.assertTrue(isinstance(dataset, zfs.ZFSFilesystem))
+		self.assertTrue(zfs.open('pool/fs') is dataset)
+		self.assertTrue(zfs.open('pool/fs', 'filesystem') is dataset)
+
+	# the tests keep a reference to the object opened first, which would
+	# otherwise leave zfs._datasets as soon as it is dropped
+	def test_reuse_checks_existence(self):
+		self.dataset = zfs.open('pool/fs')
+		self.assertTrue(zfs._datasets.get('pool/fs') is self.dataset)
+
+		zfs.clear_cache()
+		self.error = process.DatasetNotFoundError('pool/fs')
+		self.assertRaises(process.DatasetNotFoundError, zfs.open, 'pool/fs')
+		self.assertTrue(zfs._datasets.get('pool/fs') is None)
+
+	def test_reuse_type_changed(self):
+		self.dataset = zfs.open('pool/fs')
+
+		zfs.clear_cache()
+		self.output = [['pool/fs', 'type', 'volume', '-']]
+		dataset = zfs.open('pool/fs')
+		self.assertTrue(isinstance(dataset, zfs.ZFSVolume))
+		self.assertTrue(zfs._datasets.get('pool/fs') is dataset)
+		self.assertTrue(dataset is not self.dataset)
+
+class HoldsTest(ZFSTestCase):
+	output = [['pool/fs@snap', 'keep', 'Thu Jan  1  0:00 1970']]
+
+	def test_holds_many_copies(self):
+		with cache.session():
+			holds = zfs.holds_many(['pool/fs@snap'])
+			self.assertEqual(holds, {'pool/fs@snap': ['keep']})
+			holds['pool/fs@snap'].append('changed')
+			snapshot = zfs.open('pool/fs@snap', 'snapshot')
+			self.assertEqual(snapshot.holds(), ['keep'])
+		self.assertEqual(len(self.cmds), 1)
+
+class InvalidateTest(ZFSTestCase):
+	output = [['pool/fs', 'filesystem']]
+
+	def test_find_cached(self):
+		with cache.session():
+			self.assertEqual(zfs.find('pool/fs'),
+				[zfs.open('pool/fs', 'filesystem')])
+			zfs.find('pool/fs')
+			self.assertEqual(len(self.cmds), 1)
+
+			# a change to an unrelated dataset keeps the listing
+			zfs.open('other/fs', 'filesystem').snapshot('s')
+			zfs.find('pool/fs')
+			self.assertEqual(len(self.cmds), 2)
+
+			# a change within the listing drops it
+			zfs.open('pool/fs/child', 'filesystem').snapshot('s')
+			zfs.find('pool/fs')
+			self.assertEqual(len(self.cmds), 4)
+
+	def test_find_partly_read(self):
+		with cache.session():
+			next(zfs.find_iter('pool/fs'))
+			zfs.find('pool/fs')
+			self.assertEqual(len(self.cmds), 2)
+
+	def test_check_call_generation(self):
+		# a listing started before a change isn't cached
+		with cache.session():
+			datasets = zfs.find_iter('pool/fs')
+			next(datasets)
+			zfs.open('pool/fs', 'filesystem').snapshot('s')
+			list(datasets)
+			zfs.find('pool/fs')
+			self.assertEqual(len(self.cmds), 3)
+
+	def test_destroy(self):
+		with cache.session():
+			cache.props.put(('pool/fs', 'used'), '1024')
+			cache.props.put(('other/clone', 'used'), '1024')
+			zfs.open('pool/fs', 'filesystem').destroy()
+			self.assertEqual(cache.props.getprop('pool/fs', 'used'), None)
+			self.assertEqual(cache.props.getprop('other/clone', 'used'),
+				'1024')
+
+	def test_destroy_force(self):
+		with cache.session():
+			cache.props.put(('other/clone', 'used'), '1024')
+			zfs.open('pool/fs', 'filesystem').destroy(force=True)
+			self.assertEqual(cache.props.getprop('other/clone', 'used'), None)
+
+	def test_receive_close(self):
+		popen = process.popen
+		process.popen = lambda cmd, **kwargs: io.BytesIO()
+		try:
+			with cache.session():
+				f = zfs.receive('pool/fs')
+				cache.props.put(('pool/fs', 'used'), '1024')
+				f.write(b'stream')
+				f.close()
+				self.assertEqual(cache.props.getprop('pool/fs', 'used'), None)
+		finally:
+			process.popen = popen
+
+class SnapshotTest(ZFSTestCase):
+	def test_snapshot_many_pools(self):
+		zfs.snapshot_many(['tank/a@s', 'rpool/b@s', 'tank/c@s'])
+		self.assertEqual(self.cmds, [
+			['zfs', 'snapshot', 'tank/a@s', 'tank/c@s'],
+			['zfs', 'snapshot', 'rpool/b@s']])
+
+	def test_snapshot_many_same_dataset(self):
+		zfs.snapshot_many(['tank/a@s', 'tank/b@s', 'tank/a@t'])
+		self.assertEqual(self.cmds, [
+			['zfs', 'snapshot', 'tank/a@s', 'tank/b@s'],
+			['zfs', 'snapshot', 'tank/a@t']])
+
+	def test_snapshot_batch(self):
+		with zfs.snapshot_batch():
+			zfs.open('tank/a', 'filesystem').snapshot('s')
+			zfs.open('rpool/b', 'filesystem').snapshot('s')
+			zfs.open('tank/a', 'filesystem').snapshot('t')
+			self.assertEqual(self.cmds, [])
+		self.assertEqual(self.cmds, [
+			['zfs', 'snapshot', 'tank/a@s'],
+			['zfs', 'snapshot', 'rpool/b@s'],
+			['zfs', 'snapshot', 'tank/a@t']])
+
+class PropRowTest(unittest.TestCase):
+	row = zfs.PropRow(name='pool/fs', property='used', value='1024',
+		source='-')
+	expected = {'name': 'pool/fs', 'property': 'used', 'value': '1024',
+		'source': '-'}
+
+	def test_getitem(self):
+		self.assertEqual(self.row['value'], '1024')
+		self.assertEqual(self.row[2], '1024')
+		self.assertEqual(self.row[:2], ('pool/fs', 'used'))
+		self.assertRaises(KeyError, lambda: self.row['missing'])
+
+	def test_get(self):
+		self.assertEqual(self.row.get('source'), '-')
+		self.assertEqual(self.row.get('missing'), None)
+		self.assertEqual(self.row.get('missing', 'default'), 'default')
+
+	def test_contains(self):
+		self.assertTrue('value' in self.row)
+		self.assertFalse('missing' in self.row)
+		self.assertFalse('1024' in self.row)
+
+	def test_keys_values_items(self):
+		self.assertEqual(self.row.keys(),
+			['name', 'property', 'value', 'source'])
+		self.assertEqual(self.row.values(), ['pool/fs', 'used', '1024', '-'])
+		self.assertEqual(dict(self.row.items()), self.expected)
+		self.assertEqual(self.row.to_dict(), self.expected)
+
+	def test_eq(self):
+		self.assertEqual(self.row, self.expected)
+		self.assertEqual(self.expected, self.row)
+		self.assertNotEqual(self.row, dict(self.expected, value='0'))
+		self.assertEqual(self.row, ('pool/fs', 'used', '1024', '-'))
+		self.assertEqual(hash(self.row),
+			hash(('pool/fs', 'used', '1024', '-')))
+
+if __name__ == '__main__':
+	unittest.main()
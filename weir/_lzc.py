@@ -0,0 +1,96 @@
+import errno as _errno
+import os
+
+from weir import process
+
+# libzfs_core (the pyzfs bindings shipped with OpenZFS) is optional - where
+# it is installed and enabled, simple local operations are made through
+# it rather than by running zfs for each one
+try:
+	import libzfs_core
+except ImportError:
+	libzfs_core = None
+
+available = libzfs_core is not None
+
+# libzfs_core calls bypass zfs and any session, so they are made only
+# when asked for, which can be set in the environment
+enabled = available and bool(int(os.environ.get('WEIR_USE_LZC', 0)))
+
+def _encode(name):
+	return name if isinstance(name, bytes) else name.encode('utf-8')
+
+def _decode(name):
+	return name.decode('utf-8') if isinstance(name, bytes) else name
+
+# Group paths by pool, as each libzfs_core call takes snapshots of only
+# one pool
+def _by_pool(paths):
+	groups = {}
+	result = []
+	for path in paths:
+		pool = path.partition('/')[0].partition('@')[0]
+		if pool not in groups:
+			groups[pool] = []
+			result.append(groups[pool])
+		groups[pool].append(path)
+	return result
+
+# Raise the weir exception for the first known error of a failed
+# operation, otherwise re-raise the libzfs_core exception
+def _raise(e, errors):
+	for error in getattr(e, 'errors', None) or [e]:
+		Error = errors.get(getattr(error, 'errno', None))
+		name = getattr(error, 'name', None)
+		if Error is not None and name:
+			raise Error(_decode(name))
+	raise e
+
+_snapshot_errors = {
+	_errno.EEXIST: process.DatasetExistsError,
+	_errno.ENOENT: process.DatasetNotFoundError,
+	_errno.EBUSY: process.DatasetBusyError,
+}
+
+_hold_errors = {
+	_errno.EEXIST: process.HoldTagExistsError,
+	_errno.ENOENT: process.DatasetNotFoundError,
+}
+
+_release_errors = {
+	_errno.ESRCH: process.HoldTagNotFoundError,
+	_errno.ENOENT: process.DatasetNotFoundError,
+}
+
+def snapshot(paths):
+	for paths in _by_pool(paths):
+		process.log.debug('lzc_snapshot %s', ' '.join(paths))
+		try:
+			libzfs_core.lzc_snapshot([_encode(path) for path in paths])
+		except libzfs_core.exceptions.ZFSError as e:
+			_raise(e, _snapshot_errors)
+
+def hold(tag, paths):
+	for paths in _by_pool(paths):
+		process.log.debug('lzc_hold %s %s', tag, ' '.join(paths))
+		try:
+			missing = libzfs_core.lzc_hold(
+				dict((_encode(path), _encode(tag)) for path in paths))
+		except libzfs_core.exceptions.ZFSError as e:
+			_raise(e, _hold_errors)
+
+		# snapshots that don't exist are returned rather than raised
+		if missing:
+			raise process.DatasetNotFoundError(_decode(missing[0]))
+
+def release(tag, paths):
+	for paths in _by_pool(paths):
+		process.log.debug('lzc_release %s %s', tag, ' '.join(paths))
+		try:
+			missing = libzfs_core.lzc_release(
+				dict((_encode(path), [_encode(tag)]) for path in paths))
+		except libzfs_core.exceptions.ZFSError as e:
+			_raise(e, _release_errors)
+
+		if missing:
+			raise process.DatasetNotFoundError(_decode(missing[0]))
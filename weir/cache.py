@@ -0,0 +1,117 @@
+import contextlib
+import threading
+import time
+
+_clock = getattr(time, 'monotonic', time.time)
+
+# Strip any snapshot or bookmark name, so that a change to a snapshot
+# is treated as a change to its dataset
+def _dataset(name):
+	head, sep, tail = name.rpartition('/')
+	return head + sep + tail.partition('@')[0].partition('#')[0]
+
+# Whether datasets a and b are the same or one contains the other, where
+# None stands for all datasets
+def _related(a, b):
+	if a is None or b is None:
+		return True
+	if len(a) > len(b):
+		a, b = b, a
+	return b.startswith(a) and b[len(a):len(a) + 1] in ('', '/', '@', '#')
+
+# Recent results of zfs queries, so that repeated queries for the same
+# datasets or properties don't each run zfs. Entries are keyed first by
+# the dataset they concern, expire after ttl seconds, and are dropped by
+# invalidate() when a related dataset changes.
+class PropCache(object):
+	def __init__(self, ttl=0.1):
+		self.ttl = ttl
+		self.generation = 0
+		self._entries = {}
+		self._sessions = 0
+		self._started = None
+		self._lock = threading.Lock()
+
+	# within a session, entries stored since it started don't expire
+	def get(self, key):
+		entry = self._entries.get(key)
+		if entry is not None and (_clock() - entry[0] < self.ttl or
+				self._sessions and entry[0] >= self._started):
+			return entry[1]
+
+	def getprop(self, name, prop):
+		return self.get((name, prop))
+
+	# Store the result of a query started at the given generation - if
+	# anything was invalidated since, the result may be out of date and
+	# isn't stored
+	def put(self, key, value, generation=None):
+		with self._lock:
+			if generation is not None and generation != self.generation:
+				return
+			self._entries[key] = (_clock(), value)
+			self._prune()
+
+	# Store the rows from a property query, also indexing them by dataset
+	# and property so that a query covering many datasets answers
+	# getprop() for each of them - with no key only the index is stored
+	def put_rows(self, key, rows, generation=None):
+		with self._lock:
+			if generation is not None and generation != self.generation:
+				return
+			now = _clock()
+			entries = self._entries
+			if key is not None:
+				entries[key] = (now, rows)
+			for row in rows:
+				entries[(row['name'], row['property'])] = (now, row)
+			self._prune()
+
+	# drop expired entries so that the cache doesn't grow unbounded - the
+	# lock is held by the caller
+	def _prune(self):
+		now = _clock()
+		entries = self._entries
+		if len(entries) > 256 and not self._sessions:
+			for k, (t, _) in list(entries.items()):
+				if now - t >= self.ttl:
+					entries.pop(k, None)
+
+	# Forget results concerning a dataset, its parents and its children,
+	# or everything if no dataset is given
+	def invalidate(self, dataset=None):
+		# under the lock, no result of a query started before this can
+		# be stored once it returns
+		with self._lock:
+			self.generation += 1
+			if dataset is None:
+				self._entries.clear()
+				return
+
+			dataset = _dataset(dataset)
+			for k in list(self._entries):
+				if _related(k[0], dataset):
+					del self._entries[k]
+
+	# Keep results for the duration of a block of work rather than for
+	# ttl seconds - changes made through weir still invalidate them
+	@contextlib.contextmanager
+	def session(self):
+		with self._lock:
+			if not self._sessions:
+				self._started = _clock()
+			self._sessions += 1
+		try:
+			yield self
+		finally:
+			with self._lock:
+				self._sessions -= 1
+				last = not self._sessions
+			if last:
+				self.invalidate()
+
+# Cache used by weir.zfs
+props = PropCache()
+
+def session():
+	return props.session()
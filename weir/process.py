@@ -1,8 +1,31 @@
+import atexit
+import binascii
+import contextlib
 import errno as _errno
 import io
+import locale
 import logging
-import re
+import os
+import shutil
+import sys
 import threading
+import time
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+try:
+	import selectors
+except ImportError:
+	selectors = None
+try:
+	from shlex import quote
+except ImportError:
+	from pipes import quote
 
 from superprocess import Superprocess
 
@@ -14,9 +37,13 @@ PIPE = superprocess.PIPE
 STDOUT = superprocess.PIPE
 STDERR = superprocess.STDERR
 CalledProcessError = superprocess.CalledProcessError
-check_call = superprocess.check_call
-check_output = superprocess.check_output
-popen = superprocess.popen
+
+# Open a pipe to or from a command as superprocess.popen() does - the
+# stream is read or written before the process is waited for, so its
+# stderr is drained in the background meanwhile
+def popen(cmd, mode='r', buffering=-1, **kwargs):
+	return superprocess.popen(cmd, mode, buffering, drain_stderr=True,
+		**kwargs)
 
 class ZFSError(OSError):
 	def __init__(self, dataset):
@@ -42,28 +69,251 @@ class HoldTagExistsError(ZFSError):
 	errno = _errno.EEXIST
 	strerror = 'tag already exists on this dataset'
 
+# map error reasons to exception types
+_errors = dict((Error.strerror, Error) for Error in (
+	DatasetNotFoundError,
+	DatasetExistsError,
+	DatasetBusyError,
+	HoldTagNotFoundError,
+	HoldTagExistsError,))
+
 class CompletedProcess(superprocess.CompletedProcess):
 	def check_returncode(self):
 		# check for known errors of form "cannot <action> <dataset>: <reason>"
-		if self.returncode == 1:
-			pattern = r"^cannot ([^ ]+(?: [^ ]+)*?) ([^ :]+): (.+)$"
-			match = re.search(pattern, self.stderr)
-			if match:
-				action, dataset, reason = match.groups()
-				if dataset[0] == dataset[-1] == "'": dataset = dataset[1:-1]
-				for Error in (DatasetNotFoundError,
-						DatasetExistsError,
-						DatasetBusyError,
-						HoldTagNotFoundError,
-						HoldTagExistsError,):
-					if reason == Error.strerror:
-						raise Error(dataset)
-
-		# did not match known errors, defer to superclass
-		super(CompletedProcess, self).check_returncode()
+		# using string operations rather than a regex since the reasons
+		# are fixed strings
+		stderr = self.stderr
+		if self.returncode == 1 and stderr and stderr.startswith('cannot '):
+			head, _, reason = stderr.rpartition(': ')
+			Error = _errors.get(reason)
+			head = head[len('cannot '):]
+
+			# quoted names may contain spaces (and colons), so take the
+			# name from the first quote, as actions are never quoted
+			if head.endswith("'") and " '" in head[:-1]:
+				action, _, dataset = head[:-1].partition(" '")
+			else:
+				action, _, dataset = head.rpartition(' ')
+				if ':' in dataset:
+					dataset = None
+			if Error and action and dataset:
+				raise Error(dataset)
+
+		# did not match known errors, defer to superclass - keeping the
+		# last line of stderr with the error for callers to inspect
+		try:
+			super(CompletedProcess, self).check_returncode()
+		except superprocess.CalledProcessError as e:
+			e.stderr = stderr
+			raise
 
 superprocess.CompletedProcess = CompletedProcess
 
+# Whether a line is progress output of zfs send -v, which starts with the
+# time, as in "12:34:56	1234567	pool/fs@snap"
+def _progress(line):
+	t = line[:9]
+	return len(t) == 9 and t[2] == t[5] == ':' and t[8] in ' \t' and \
+		(t[:2] + t[3:5] + t[6:8]).isdigit()
+
+_clock = getattr(time, 'monotonic', time.time)
+
+# Write lines from a process's stderr to the log, keeping the most recent
+# line so that it can be checked for errors once the process has finished
+class _StderrLog(object):
+	# zfs send -v writes progress lines faster than is useful to log, so
+	# log at most one of them per interval - other lines are always logged
+	interval = 0.5
+
+	def __init__(self, file):
+		self.file = file
+		self.last = None
+		self.done = threading.Event()
+		self._buffer = b''
+		self._logged = None
+		self._skipped = None
+
+	def line(self, msg):
+		self.last = msg
+		if _progress(msg):
+			now = _clock()
+			if self._logged is not None and now - self._logged < self.interval:
+				self._skipped = msg
+				return
+			self._logged = now
+			self._skipped = None
+		else:
+			self._flush()
+		log.debug(msg)
+
+	# log the latest progress line skipped, so that it isn't lost
+	def _flush(self):
+		if self._skipped is not None:
+			log.debug(self._skipped)
+			self._skipped = None
+
+	def finish(self):
+		self._flush()
+		self.done.set()
+
+	# feed raw output read by the reactor
+	def feed(self, data):
+		lines = (self._buffer + data).split(b'\n')
+		self._buffer = lines.pop()
+		encoding = locale.getpreferredencoding(False)
+		for line in lines:
+			self.line(line.decode(encoding, 'replace'))
+
+	def close(self):
+		if self._buffer:
+			self.feed(b'\n')
+		self.file.close()
+		self.finish()
+
+	# drain the stream from a dedicated thread where there is no reactor
+	def start(self):
+		stderr = self.file
+		if not isinstance(stderr, io.TextIOBase):
+			if not isinstance(stderr, io.BufferedIOBase):
+				stderr = io.BufferedReader(stderr)
+			stderr = io.TextIOWrapper(stderr)
+
+		def drain():
+			with stderr as f:
+				for line in f:
+					self.line(line.rstrip('\n'))
+			self.finish()
+		t = threading.Thread(target=drain)
+		t.daemon = True
+		t.start()
+
+	def read(self):
+		self.done.wait()
+		return self.last
+
+# Drain stderr of all running processes from a single thread rather than
+# starting a thread for every process
+class _StderrReactor(object):
+	def __init__(self):
+		self.pid = None
+		self._start()
+
+	def _start(self):
+		self.pid = os.getpid()
+		self.selector = selectors.DefaultSelector()
+		self.lock = threading.Lock()
+		self.pending = []
+		self.thread = None
+
+		# pipe used to wake the reactor when new streams are added
+		self.wakeup, self._wakeup = os.pipe()
+		self.selector.register(self.wakeup, selectors.EVENT_READ)
+
+	# a forked child has none of the parent's threads, and shares its
+	# selector, so it starts over with its own
+	def _restart(self):
+		self.selector.close()
+		os.close(self.wakeup)
+		os.close(self._wakeup)
+		self._start()
+
+	def add(self, stderr):
+		if self.pid != os.getpid():
+			self._restart()
+		with self.lock:
+			self.pending.append(stderr)
+			if self.thread is None:
+				self.thread = threading.Thread(target=self.run)
+				self.thread.daemon = True
+				self.thread.start()
+		os.write(self._wakeup, b'\0')
+
+	def run(self):
+		while True:
+			for key, _ in self.selector.select():
+				if key.data is None:
+					os.read(self.wakeup, 512)
+					with self.lock:
+						pending, self.pending = self.pending, []
+					for stderr in pending:
+						self.selector.register(
+							stderr.file.fileno(), selectors.EVENT_READ, stderr)
+					continue
+
+				data = os.read(key.fd, 65536)
+				if data:
+					key.data.feed(data)
+				else:
+					self.selector.unregister(key.fd)
+					key.data.close()
+
+_reactor = _StderrReactor() if selectors is not None else None
+
+# Shared pool of threads for running independent commands concurrently,
+# created on first use
+_pool = None
+_pool_size = 8
+_pool_lock = threading.Lock()
+
+def pool():
+	global _pool
+	with _pool_lock:
+		if _pool is None:
+			from multiprocessing.pool import ThreadPool
+			_pool = ThreadPool(_pool_size)
+
+			# finish queued work at exit, so that background changes
+			# aren't lost, and stop the threads rather than leaving them
+			# to be torn down with the interpreter
+			atexit.register(_close_pool, _pool)
+	return _pool
+
+def _close_pool(pool):
+	pool.close()
+	pool.join()
+
+# Threads of the shared pool mark themselves here when they run a task
+_worker = threading.local()
+
+# Map func over items on the shared pool - from within a pool thread
+# the items are mapped in that thread, as waiting on the pool from it
+# could deadlock once every thread is waiting
+def pool_map(func, items):
+	if getattr(_worker, 'active', False):
+		return [func(item) for item in items]
+
+	def call(item):
+		_worker.active = True
+		return func(item)
+	return pool().map(call, items)
+
+# Run func on the shared pool, returning a result whose get() waits for
+# it - as with pool_map(), from within a pool thread it runs immediately
+def pool_apply(func, *args):
+	if getattr(_worker, 'active', False):
+		return _Result(func(*args))
+
+	def call():
+		_worker.active = True
+		return func(*args)
+	return pool().apply_async(call)
+
+class _Result(object):
+	def __init__(self, value):
+		self.value = value
+
+	def get(self, timeout=None):
+		return self.value
+
+# Executables found on the path, keyed by name and path
+_executables = {}
+
+def _which(name):
+	key = (name, os.environ.get('PATH'))
+	if key not in _executables:
+		_executables[key] = shutil.which(name)
+	return _executables[key]
+
 class Popen(superprocess.Popen):
 	def __init__(self, cmd, **kwargs):
 		# zfs commands don't require setting both stdin and stdout
@@ -80,36 +330,286 @@ class Popen(superprocess.Popen):
 		# use text mode by default
 		universal_newlines = kwargs.pop('universal_newlines', True)
 
+		# verbose commands write to stderr while they run, as may any
+		# command whose output is streamed rather than collected by
+		# communicate()
+		drain_stderr = kwargs.pop('drain_stderr', False) or '-v' in cmd
+
+		# Python 3 creates file descriptors non-inheritable, so there is no
+		# need to close them in the child - with that and a full path to
+		# the executable (or to ssh for remote commands), subprocess can
+		# use posix_spawn() instead of fork()
+		if sys.version_info >= (3, 4):
+			kwargs.setdefault('close_fds', False)
+			if kwargs.get('netloc'):
+				kwargs.setdefault('remote_shell', _which('ssh'))
+			else:
+				kwargs.setdefault('executable', _which(cmd[0]))
+
 		# start process
-		log.debug(' '.join(cmd))
+		if log.isEnabledFor(logging.DEBUG):
+			log.debug(' '.join(cmd))
 		super(Popen, self).__init__(
 			cmd, stdin=stdin, stdout=stdout, stderr=superprocess.PIPE,
 			universal_newlines=universal_newlines, **kwargs)
 
-		# set stderr aside for logging and ensure it is a text stream
-		stderr, self.stderr = self.stderr, None
-		if not isinstance(stderr, io.TextIOBase):
-			if not isinstance(stderr, io.BufferedIOBase):
-				stderr = io.BufferedReader(stderr)
-			stderr = io.TextIOWrapper(stderr)
+		# set stderr aside to be logged in the background where it must
+		# be drained - otherwise it is read only once the command has
+		# finished
+		self._stderr_read = None
+		if drain_stderr:
+			stderr = _StderrLog(self.stderr)
+			self.stderr = None
+			if _reactor is not None:
+				_reactor.add(stderr)
+			else:
+				stderr.start()
+			self._stderr_read = stderr.read
 
-		# write stderr to log and store most recent line for analysis
-		_stderr = [None]
-		def log_stderr():
-			with stderr as f:
-				for line in f:
-					msg = line.rstrip('\n')
-					log.debug(msg)
-					_stderr[0] = msg
-		t = threading.Thread(target=log_stderr)
+	def communicate(self, *args, **kwargs):
+		stdout, stderr = super(Popen, self).communicate(*args, **kwargs)
+		output = None if stdout is None else \
+			[line.split('\t') for line in stdout.splitlines()]
+
+		# write stderr to log and keep most recent line for analysis
+		if self._stderr_read is not None:
+			return output, self._stderr_read()
+		if isinstance(stderr, bytes):
+			stderr = stderr.decode(locale.getpreferredencoding(False), 'replace')
+		msg = None
+		for msg in (stderr or '').splitlines():
+			log.debug(msg)
+		return output, msg
+
+_BasePopen, superprocess.Popen = superprocess.Popen, Popen
+
+# A long-lived shell that runs commands one after another, avoiding the
+# cost of starting a new process (and for remote hosts, a new connection)
+# for every command
+class Session(object):
+	def __init__(self, netloc=None):
+		self.netloc = netloc
+		self._lock = threading.Lock()
+		self._marker = '__weir_{0}__'.format(
+			binascii.hexlify(os.urandom(8)).decode('ascii'))
+		self._process = _BasePopen(['sh', '-s'],
+			stdin=PIPE, stdout=PIPE, stderr=PIPE,
+			universal_newlines=True, netloc=netloc)
+
+		# drain stderr continuously so that the shell never blocks on it
+		self._stderr = queue.Queue()
+		t = threading.Thread(target=self._drain_stderr)
 		t.daemon = True
 		t.start()
-		self._stderr_read = lambda: t.join() or _stderr[0]
 
-	def communicate(self, *args, **kwargs):
-		stdout, _ = super(Popen, self).communicate(*args, **kwargs)
-		output = None if stdout is None else \
-			[tuple(line.split('\t')) for line in stdout.splitlines()]
-		return output, self._stderr_read()
+	def _drain_stderr(self):
+		with self._process.stderr as f:
+			for line in f:
+				self._stderr.put(line.rstrip('\n'))
+		self._stderr.put(None)
+
+	# commands from different threads are run one at a time
+	def run(self, cmd):
+		with self._lock:
+			return self._run(cmd)
+
+	def _run(self, cmd):
+		if log.isEnabledFor(logging.DEBUG):
+			log.debug(' '.join(cmd))
+
+		# run the command, then write a marker with its return code to
+		# stdout and a marker to stderr
+		p = self._process
+		p.stdin.write('{0} </dev/null; echo "{1} $?"; echo {1} >&2\n'.format(
+			' '.join(quote(arg) for arg in cmd), self._marker))
+		p.stdin.flush()
+
+		output = []
+		for line in p.stdout:
+			if line.startswith(self._marker):
+				returncode = int(line.split()[1])
+				break
+			output.append(line.rstrip('\n').split('\t'))
+		else:
+			raise CalledProcessError(p.wait(), p.args)
+
+		# write stderr to log and store most recent line for analysis
+		stderr = None
+		while True:
+			line = self._stderr.get()
+			if line is None or line == self._marker:
+				break
+			log.debug(line)
+			stderr = line
+
+		return CompletedProcess(cmd, returncode, output, stderr)
+
+	def close(self):
+		self._process.stdin.close()
+		self._process.stdout.close()
+		self._process.wait()
+
+# Sessions in use and the number of with blocks using each, by host
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# Run commands for the given host through a single shell for the
+# duration of the with block - this applies to commands from all threads,
+# including those run concurrently on the shared pool
+@contextlib.contextmanager
+def session(netloc=None):
+	netloc = netloc or None
+	with _sessions_lock:
+		entry = _sessions.get(netloc)
+		if entry is None:
+			entry = _sessions[netloc] = [Session(netloc), 0]
+		entry[1] += 1
+
+	try:
+		yield entry[0]
+	finally:
+		_release(netloc, entry)
+
+# Drop a use of a session, closing it once nothing uses it
+def _release(netloc, entry):
+	with _sessions_lock:
+		entry[1] -= 1
+		if entry[1]:
+			return
+		del _sessions[netloc]
+	entry[0].close()
+
+# Run a command in the active session for its host, if there is one and
+# the command can be run in it, otherwise return None. The session is
+# counted as in use while the command runs, so that it stays open even if
+# the with block that started it ends meanwhile.
+def _session_run(cmd, kwargs):
+	if not _sessions or not set(kwargs) <= set(['netloc']):
+		return None
+	netloc = kwargs.get('netloc') or None
+	with _sessions_lock:
+		entry = _sessions.get(netloc)
+		if entry is None:
+			return None
+		entry[1] += 1
+
+	try:
+		result = entry[0].run(cmd)
+	finally:
+		_release(netloc, entry)
+	result.check_returncode()
+	return result
+
+def check_call(cmd, **kwargs):
+	result = _session_run(cmd, kwargs)
+	if result is None:
+		return superprocess.check_call(cmd, **kwargs)
+	return result.returncode
+
+def check_output(cmd, **kwargs):
+	result = _session_run(cmd, kwargs)
+	if result is None:
+		return superprocess.check_output(cmd, **kwargs)
+	return result.stdout
+
+# Call a function in the background on the shared pool, returning a
+# result whose get() waits for it and raises any error. Results of
+# background changes are often never collected, so errors are logged as
+# well - this is done in the call rather than with error_callback, which
+# Python 2 lacks.
+def call_async(func, *args, **kwargs):
+	def call():
+		# mark the thread as pool_map() does, so that func never waits on
+		# the pool it is running in
+		_worker.active = True
+		try:
+			return func(*args, **kwargs)
+		except Exception as e:
+			log.warning('background call failed: %s', e)
+			raise
+	return pool().apply_async(call)
+
+# Run a command in the background, as for call_async()
+def spawn_async(cmd, **kwargs):
+	return call_async(check_call, cmd, **kwargs)
+
+# Wait for several background commands, raising the first error
+def wait_all(results):
+	return [result.get() for result in results]
+
+# Iterate over rows of command output as they are produced rather than
+# waiting for the command to finish and collecting all of its output
+def check_output_iter(cmd, **kwargs):
+	if 'stdout' in kwargs:
+		raise ValueError('stdout argument not allowed, it will be overridden')
+	result = _session_run(cmd, kwargs)
+	if result is not None:
+		for row in result.stdout:
+			yield row
+		return
+	p = superprocess.Popen(cmd, stdout=PIPE, drain_stderr=True, **kwargs)
+
+	# detach stdout so that communicate() only waits for the process
+	f, p.stdout = p.stdout, None
+	try:
+		for line in f:
+			yield line.rstrip('\n').split('\t')
+	finally:
+		f.close()
+		_, stderr = p.communicate()
+
+	result = superprocess.CompletedProcess(p.args, p.returncode, None, stderr)
+	result.check_returncode()
+
+# Linux allows the buffer of a pipe to be resized
+_F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ',
+	1031 if sys.platform.startswith('linux') else None)
+
+# Enlarge the buffer of the pipe behind a file, so that a process writing
+# a stream (such as zfs send) isn't held up whenever the reader falls
+# briefly behind. This is best effort: without privileges the size is
+# limited to /proc/sys/fs/pipe-max-size, and elsewhere nothing is done.
+def set_pipe_size(f, size):
+	if fcntl is None or _F_SETPIPE_SZ is None or not size:
+		return
+	try:
+		fcntl.fcntl(f.fileno(), _F_SETPIPE_SZ, size)
+	except (IOError, OSError) as e:
+		if e.errno != _errno.EPERM:
+			return
+		try:
+			with io.open('/proc/sys/fs/pipe-max-size') as limit:
+				size = min(size, int(limit.read()))
+			fcntl.fcntl(f.fileno(), _F_SETPIPE_SZ, size)
+		except (IOError, OSError, ValueError):
+			pass
+
+# Copy a stream from one file to another. Where one side is a pipe (as
+# for zfs send and receive) and splice() is available, data is moved
+# between the file descriptors within the kernel rather than being read
+# into and written out from Python.
+def copy(src, dst, length=1 << 20):
+	splice = getattr(os, 'splice', None)
+	try:
+		src_fd, dst_fd = src.fileno(), dst.fileno()
+	except (AttributeError, io.UnsupportedOperation):
+		splice = None
+
+	if splice is not None:
+		# pass on any data already read into the source's buffer
+		if hasattr(src, 'peek'):
+			buffered = len(src.peek(length))
+			if buffered:
+				dst.write(src.read(buffered))
+		dst.flush()
+
+		try:
+			while splice(src_fd, dst_fd, length):
+				pass
+			return
+		except OSError as e:
+			# neither file is a pipe: fall back to copying
+			if e.errno != _errno.EINVAL:
+				raise
 
-superprocess.Popen = Popen
+	shutil.copyfileobj(src, dst, length)
@@ -0,0 +1,58 @@
+import errno as _errno
+import os
+import signal
+
+from weir import process, zfs
+
+# Default concurrency limits, which can be set in the environment
+max_concurrent_send = int(os.environ.get('WEIR_MAX_CONCURRENT_SEND', 4))
+max_concurrent_recv = int(os.environ.get('WEIR_MAX_CONCURRENT_RECV', 4))
+
+# Send a snapshot (incrementally from base if given) and receive it into
+# target, copying the stream between the two commands
+def replicate(snapshot, target, base=None):
+	if not isinstance(snapshot, zfs.ZFSSnapshot):
+		snapshot = zfs.open(snapshot, 'snapshot')
+
+	stream = snapshot.send(base=base)
+	try:
+		zfs.receive(target, file=stream)
+	except Exception:
+		_close_send(stream)
+		raise
+	stream.close()
+
+# Close a send stream after receive has failed - send failing on the pipe
+# that receive stopped reading is left for the receive error to explain,
+# but any other send error is raised in its place
+def _close_send(stream):
+	try:
+		stream.close()
+	except process.CalledProcessError as e:
+		stderr = getattr(e, 'stderr', None) or ''
+		if e.returncode != -signal.SIGPIPE and \
+				not stderr.endswith(_broken_pipe):
+			raise
+
+_broken_pipe = os.strerror(_errno.EPIPE)
+
+# Replicate several snapshots concurrently - pairs are (snapshot, target)
+# or (snapshot, target, base) tuples, and at most concurrency streams
+# run at once
+def pipeline(pairs, concurrency=None):
+	if concurrency is None:
+		concurrency = min(max_concurrent_send, max_concurrent_recv)
+
+	pairs = list(pairs)
+	if not pairs:
+		return
+
+	# use a separate pool, as the shared one may be needed by the
+	# commands in each stream
+	from multiprocessing.pool import ThreadPool
+	pool = ThreadPool(min(concurrency, len(pairs)))
+	try:
+		pool.map(lambda pair: replicate(*pair), pairs, chunksize=1)
+	finally:
+		pool.close()
+		pool.join()
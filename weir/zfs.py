@@ -1,118 +1,417 @@
+import collections
+import contextlib
+import functools
+import itertools
 import logging
+import threading
+import weakref
 try:
-	from urllib.parse import urlsplit, urlunsplit, SplitResult
+	from urllib.parse import SplitResult
 except ImportError:
-	from urlparse import urlsplit, urlunsplit, SplitResult
+	from urlparse import SplitResult
 
-from weir import process
+from weir import _lzc, cache, process
 
 log = logging.getLogger(__name__)
 
-# Split a zfs dataset url
+# Split a zfs dataset url of the form [scheme://netloc/]path - parsed by
+# hand rather than with urlsplit(), which is slower and would take the
+# bookmark separator '#' for a fragment and 'pool:' for a scheme
 def _urlsplit(url):
-	scheme, netloc, path, query, fragment = urlsplit(url)
-	return SplitResult(scheme, netloc, path.strip('/'), query, fragment)
-
-# Replace components of url
-def _urlupdate(url, scheme=None, netloc=None,
-		path=None, query=None, fragment=None):
-	return urlunsplit(new if new is not None else old for new, old in
-		zip((scheme, netloc, path, query, fragment), urlsplit(url)))
-
-def find(path=None, max_depth=None, types=[]):
-	url = _urlsplit(path) if path \
-		else SplitResult(None, None, None, None, None)
+	result = _splits.get(url)
+	if result is None:
+		scheme, sep, rest = url.partition('://')
+		if sep:
+			netloc, _, path = rest.partition('/')
+		else:
+			scheme, netloc, path = '', '', url
+		result = SplitResult(scheme, netloc, path.strip('/'), '', '')
 
-	cmd = ['zfs', 'list']
+		# the same urls recur, so keep recent results
+		if len(_splits) >= 1024:
+			_splits.clear()
+		_splits[url] = result
+	return result
 
-	cmd.append('-H')
+_splits = {}
 
+# Replace components of url
+def _urlupdate(url, scheme=None, netloc=None, path=None):
+	old = _urlsplit(url or '')
+	scheme = old.scheme if scheme is None else scheme
+	netloc = old.netloc if netloc is None else netloc
+	path = old.path if path is None else path
+	if scheme or netloc:
+		return '{0}://{1}/{2}'.format(scheme, netloc, path)
+	return path
+
+# Verbose zfs output is only written to the debug log, so don't ask
+# for it unless it will be logged - send() and receive() also accept
+# verbose to override this, eg when called repeatedly in a loop
+def _verbose():
+	return process.log.isEnabledFor(logging.DEBUG)
+
+# Arguments limiting the depth of a recursive zfs list or zfs get
+def _depth_args(max_depth):
 	if max_depth is None:
-		cmd.append('-r')
+		return ('-r',)
 	elif max_depth >= 0:
-		cmd.append('-d')
-		cmd.append(str(max_depth))
+		return ('-d', str(max_depth))
 	else:
 		raise TypeError('max_depth must be a non-negative int or None')
 
+def find(path=None, max_depth=None, types=()):
+	return list(find_iter(path, max_depth, types))
+
+# Like find(), but yield datasets as zfs list produces them rather than
+# reading the whole list first
+def find_iter(path=None, max_depth=None, types=()):
+	key = (path, max_depth, tuple(types))
+	datasets = cache.props.get(key)
+	if datasets is not None:
+		return iter(datasets)
+
+	url = _urlsplit(path) if path \
+		else SplitResult(None, None, None, None, None)
+	return _cached(key, _find(path or '', url.netloc,
+		[url.path] if url.path else [], max_depth, types))
+
+# Pass on items from an iterator, caching them under key once it has
+# been read to the end
+def _cached(key, items):
+	generation = cache.props.generation
+	result = []
+	for item in items:
+		result.append(item)
+		yield item
+	cache.props.put(key, result, generation)
+
+# Forget all cached results, eg after datasets were changed other than
+# through weir
+def clear_cache():
+	cache.props.invalidate()
+
+# Names of datasets, without their types - zfs list can skip opening
+# each dataset when only names are asked for, which is much faster
+def find_names(path=None, max_depth=None, types=()):
+	url = _urlsplit(path) if path \
+		else SplitResult(None, None, None, None, None)
+	return list(_list_names(path or '', url.netloc,
+		[url.path] if url.path else [], max_depth, types))
+
+# Run zfs list for paths on a single host with the given output columns
+def _list(netloc, paths, max_depth, types, columns):
+	cmd = ['zfs', 'list', '-H']
+
+	cmd.extend(_depth_args(max_depth))
+
 	if types:
-		cmd.append('-t')
-		cmd.append(','.join(types))
+		cmd.extend(('-t', ','.join(types)))
+
+	cmd.extend(('-o', columns))
+
+	cmd.extend(paths)
+
+	return process.check_output_iter(cmd, netloc=netloc)
+
+def _list_names(base, netloc, paths, max_depth, types):
+	for name, in _list(netloc, paths, max_depth, types, 'name'):
+		yield _urlupdate(base, path=name)
+
+# List datasets under paths on a single host with one zfs list, building
+# their names from the url base
+def _find(base, netloc, paths, max_depth, types):
+	# the type of each dataset is known if only one type was asked for,
+	# so list names only
+	if len(types) == 1 and types[0] in _types:
+		type = types[0]
+		for name in _list_names(base, netloc, paths, max_depth, types):
+			yield open(name, type)
+		return
+
+	for name, type in _list(netloc, paths, max_depth, types, 'name,type'):
+		yield open(_urlupdate(base, path=name), type)
+
+# Group dataset urls by host as (base url, netloc, paths) tuples
+def _group_by_host(names):
+	groups = {}
+	result = []
+	for name in names:
+		url = _urlsplit(name)
+		key = (url.scheme, url.netloc)
+		if key not in groups:
+			groups[key] = (name, url.netloc, [])
+			result.append(groups[key])
+		groups[key][2].append(url.path)
+	return result
+
+# Group snapshot urls as for _group_by_host(), but also by pool, as zfs
+# snapshot and libzfs_core take snapshots of only one pool at a time -
+# with split_datasets, also so that no group has two snapshots of the
+# same dataset, which zfs snapshot doesn't allow either
+def _group_by_pool(names, split_datasets=False):
+	result = []
+	for base, netloc, paths in _group_by_host(names):
+		groups = {}
+		for path in paths:
+			dataset = path.partition('@')[0]
+			pool = dataset.partition('/')[0]
+			for group in groups.setdefault(pool, []):
+				if not split_datasets or dataset not in group[1]:
+					break
+			else:
+				group = ((base, netloc, []), set())
+				groups[pool].append(group)
+				result.append(group[0])
+			group[0][2].append(path)
+			group[1].add(dataset)
+	return result
+
+# Find datasets under several paths, with one zfs list for the paths on
+# each host and the hosts listed concurrently
+def find_many(paths, max_depth=None, types=()):
+	def find_group(group):
+		base, netloc, paths = group
+		# an empty path means all datasets on the host
+		if not all(paths):
+			paths = []
+		return list(_find(base, netloc, paths, max_depth, types))
+
+	results = process.pool_map(find_group, _group_by_host(paths))
+	return [dataset for datasets in results for dataset in datasets]
+
+# Run a command that changes the named datasets, dropping any cached
+# results about them - unless wait is true it runs in the background,
+# returning a result as for process.spawn_async(). For local datasets lzc
+# may give an equivalent libzfs_core call to make instead if enabled.
+def _check_call(cmd, netloc, names, wait=True, lzc=None):
+	if not wait:
+		return process.call_async(_check_call, cmd, netloc, names, True, lzc)
+	try:
+		if lzc is not None and _lzc.enabled and not netloc:
+			lzc()
+		else:
+			process.check_call(cmd, netloc=netloc)
+	finally:
+		for name in names:
+			cache.props.invalidate(name)
+
+# A row of zfs get output. Rows used to be dicts, so fields can also be
+# read by name as with a dict, and to_dict() gives a dict copy.
+class PropRow(collections.namedtuple('PropRow', 'name property value source')):
+	__slots__ = ()
+
+	def __getitem__(self, key):
+		if isinstance(key, (int, slice)):
+			return tuple.__getitem__(self, key)
+		if key not in self._fields:
+			raise KeyError(key)
+		return getattr(self, key)
 
-	cmd.append('-o')
-	cmd.append('name,type')
+	def __contains__(self, key):
+		return key in self._fields
 
-	if url.path:
-		cmd.append(url.path)
+	def __eq__(self, other):
+		if isinstance(other, dict):
+			return self.to_dict() == other
+		return tuple.__eq__(self, other)
 
-	return [open(_urlupdate(path, path=name), type)
-		for name, type in process.check_output(cmd, netloc=url.netloc)]
+	def __ne__(self, other):
+		return not self == other
 
+	__hash__ = tuple.__hash__
+
+	def get(self, key, default=None):
+		return getattr(self, key) if key in self._fields else default
+
+	def keys(self):
+		return list(self._fields)
+
+	def values(self):
+		return list(self)
+
+	def items(self):
+		return list(zip(self._fields, self))
+
+	def to_dict(self):
+		return dict(zip(self._fields, self))
+
+# note: numeric means exact numeric values (zfs get -p) rather than
+# human-readable ones such as 1.5G
 def findprops(path=None, max_depth=None,
-		props=['all'], sources=[], types=[]):
+		props=('all',), sources=(), types=(), numeric=True):
+	key = (path, max_depth, tuple(props), tuple(sources), tuple(types),
+		numeric)
+	rows = cache.props.get(key)
+	if rows is None:
+		generation = cache.props.generation
+		rows = list(_findprops(path, max_depth, props, sources, types,
+			numeric))
+
+		# only numeric values may answer getprop()
+		if numeric:
+			cache.props.put_rows(key, rows, generation)
+		else:
+			cache.props.put(key, rows, generation)
+
+	return list(rows)
+
+# Like findprops(), but yield rows as zfs get produces them rather than
+# reading the whole table first - the results are not cached
+def iterprops(path=None, max_depth=None,
+		props=('all',), sources=(), types=(), numeric=True):
+	return _findprops(path, max_depth, props, sources, types, numeric)
+
+# Whether zfs get -t is supported on each host, once known
+_get_types = {}
+
+def _findprops(path, max_depth, props, sources, types, numeric):
 	url = _urlsplit(path) if path \
 		else SplitResult(None, None, None, None, None)
 
-	cmd = ['zfs', 'get']
-
-	cmd.append('-H')
-	cmd.append('-p')
+	# zfs list gives names without looking up any properties - zfs get
+	# covers all types by default, where zfs list leaves out snapshots
+	if list(props) == ['name'] and not sources:
+		for name in _list_names(path or '', url.netloc,
+				[url.path] if url.path else [], max_depth, types or ('all',)):
+			yield PropRow(name=name, property='name', value=_urlsplit(name).path,
+				source='-')
+		return
 
-	# workaround for lack of support for zfs get -t types in ZEVO:
-	# use zfs list to find relevant datasets
-	if True and types:
-		paths = [dataset._url.path for dataset in
-			find(path, max_depth=max_depth, types=types)]
+	options = ['-p'] if numeric else []
 
-		if not paths:
-			return []
-	else:
-		if max_depth is None:
-			cmd.append('-r')
-		elif max_depth >= 0:
-			cmd.append('-d')
-			cmd.append(str(max_depth))
+	if not types or _get_types.get(url.netloc or None, True):
+		args = options + list(_depth_args(max_depth))
+		if types:
+			args.extend(('-t', ','.join(types)))
+
+		rows = _get(url.netloc, args, props, sources,
+			[url.path] if url.path else [])
+
+		# zfs get -t isn't supported everywhere (eg ZEVO), which shows
+		# as a usage error before any output - as does an invalid
+		# property or type, so this is only known once the workaround
+		# below has succeeded
+		try:
+			row = next(rows, None)
+		except process.CalledProcessError as e:
+			if not types or e.returncode != 2:
+				raise
 		else:
-			raise TypeError('max_depth must be a non-negative int or None')
+			if types:
+				_get_types[url.netloc or None] = True
+			if row is not None:
+				rows = itertools.chain((row,), rows)
+			for n, p, v, s in rows:
+				yield PropRow(name=_urlupdate(path, path=n),
+					property=p, value=v, source=s)
+			return
 
-		if types:
-			cmd.append('-t')
-			cmd.append(','.join(types))
+	# workaround for lack of support for zfs get -t types:
+	# use zfs list to find relevant datasets, passing them on to zfs get
+	# as they are listed
+	paths = (name for name, in _list(url.netloc,
+		[url.path] if url.path else [], max_depth, types, 'name'))
+
+	first = next(paths, None)
+	if first is None:
+		return
+
+	paths = itertools.chain((first,), paths)
+	for n, p, v, s in _get(url.netloc, options, props, sources, paths):
+		yield PropRow(name=_urlupdate(path, path=n), property=p, value=v, source=s)
 
-		paths = [url.path] if url.path else []
+	_get_types[url.netloc or None] = False
+
+# Run zfs get for paths on a single host, yielding the output rows
+def _get(netloc, args, props, sources, paths):
+	cmd = ['zfs', 'get', '-H']
+
+	cmd.extend(args)
 
 	if sources:
-		cmd.append('-s')
-		cmd.append(','.join(sources))
+		cmd.extend(('-s', ','.join(sources)))
 
 	cmd.append(','.join(props))
 
-	cmd.extend(paths)
-
-	return [dict(name=_urlupdate(path, path=n), property=p, value=v, source=s)
-		for n, p, v, s in process.check_output(cmd, netloc=url.netloc)]
+	# get the properties of a long list of datasets in chunks on the pool,
+	# starting on each chunk as soon as its paths are known
+	paths = iter(paths)
+	chunk = list(itertools.islice(paths, _chunk_size))
+	chunks = iter(lambda: list(itertools.islice(paths, _chunk_size)), [])
+	second = next(chunks, None)
+	if second is None:
+		return process.check_output_iter(cmd + chunk, netloc=netloc)
+
+	def get_chunk(chunk):
+		return list(process.check_output_iter(cmd + chunk, netloc=netloc))
+
+	results = [process.pool_apply(get_chunk, chunk)
+		for chunk in itertools.chain((chunk, second), chunks)]
+	return itertools.chain.from_iterable(result.get() for result in results)
+
+# Number of datasets given to each zfs get when getting the properties
+# of many datasets
+_chunk_size = 64
+
+# Get properties under several paths, with the paths handled concurrently
+def findprops_many(paths, max_depth=None,
+		props=('all',), sources=(), types=(), numeric=True):
+	def get_path(path):
+		return findprops(path, max_depth, props, sources, types, numeric)
+
+	results = process.pool_map(get_path, paths)
+	return [row for rows in results for row in rows]
+
+# Get properties of several datasets with one zfs get per host, returning
+# {name: {property: row}} - the rows are also cached, so getprop() on
+# each dataset can use them
+def findprops_bulk(names, props=('all',)):
+	def get_group(group):
+		base, netloc, paths = group
+		return [PropRow(name=_urlupdate(base, path=n), property=p, value=v,
+			source=s) for n, p, v, s in _get(netloc, ['-p'], props, (), paths)]
+
+	generation = cache.props.generation
+	result = {}
+	for rows in process.pool_map(get_group, _group_by_host(names)):
+		cache.props.put_rows(None, rows, generation)
+		for row in rows:
+			result.setdefault(row['name'], {})[row['property']] = row
+	return result
+
+# Dataset objects currently in use, so that opening a dataset again
+# returns the same object
+_datasets = weakref.WeakValueDictionary()
 
 # Factory function for dataset objects
 def open(name, type=None):
+	# looking up the type also checks that the dataset (still) exists -
+	# the prop cache answers this for repeated opens
 	if type is None:
-		type = findprops(name, max_depth=0, props=['type'])[0]['value']
-
-	if type == 'volume':
-		return ZFSVolume(name)
+		try:
+			type = findprops(name, max_depth=0, props=['type'])[0]['value']
+		except process.DatasetNotFoundError:
+			_datasets.pop(name, None)
+			raise
 
-	if type == 'filesystem':
-		return ZFSFilesystem(name)
+	dataset = _datasets.get(name)
+	if dataset is not None and dataset.type == type:
+		return dataset
 
-	if type == 'snapshot':
-		return ZFSSnapshot(name)
+	try:
+		cls = _types[type]
+	except KeyError:
+		raise ValueError('invalid dataset type %s' % type)
 
-	raise ValueError('invalid dataset type %s' % type)
+	dataset = _datasets[name] = cls(name)
+	return dataset
 
 def roots():
 	return find(max_depth=0)
 
 # note: force means create missing parent filesystems
-def create(name, type='filesystem', props={}, force=False):
+def create(name, type='filesystem', props=None, force=False):
 	url = _urlsplit(name)
 
 	cmd = ['zfs', 'create']
@@ -125,22 +424,27 @@ def create(name, type='filesystem', props={}, force=False):
 	if force:
 		cmd.append('-p')
 
-	for prop, value in props.items():
-		cmd.append('-o')
-		cmd.append(prop + '=' + str(value))
+	for prop, value in (props or {}).items():
+		cmd.extend(('-o', '%s=%s' % (prop, value)))
 
 	cmd.append(url.path)
 
-	process.check_call(cmd, netloc=url.netloc)
-	return ZFSFilesystem(name)
+	_check_call(cmd, url.netloc, [name])
+	return open(name, 'filesystem')
 
+# note: if file is given the stream is read from it, otherwise an open
+# file is returned for the caller to write the stream to
 def receive(name, append_name=False, append_path=False,
-		force=False, nomount=False):
+		force=False, nomount=False, file=None, verbose=None,
+		buffer_size=1 << 20):
 	url = _urlsplit(name)
 
 	cmd = ['zfs', 'receive']
 
-	cmd.append('-v')
+	if verbose is None:
+		verbose = _verbose()
+	if verbose:
+		cmd.append('-v')
 
 	if append_name:
 		cmd.append('-e')
@@ -154,9 +458,144 @@ def receive(name, append_name=False, append_path=False,
 
 	cmd.append(url.path)
 
-	return process.popen(cmd, mode='wb', netloc=url.netloc)
+	cache.props.invalidate(name)
+	f = process.popen(cmd, mode='wb', netloc=url.netloc)
+	process.set_pipe_size(f, buffer_size)
+	if file is None:
+		# the stream is received by the time the caller closes the file
+		close = f.close
+		def close_and_invalidate():
+			try:
+				close()
+			finally:
+				cache.props.invalidate(name)
+		f.close = close_and_invalidate
+		return f
+
+	try:
+		process.copy(file, f)
+	finally:
+		try:
+			f.close()
+		finally:
+			cache.props.invalidate(name)
+
+# Hold several snapshots with one zfs hold per host - callers holding
+# a list of snapshots should use this rather than hold() on each
+def hold_many(tag, snapshots, recursive=False, wait=True):
+	return _tag_many('hold', tag, snapshots, recursive, wait)
+
+# Release holds on several snapshots with one zfs release per host
+def release_many(tag, snapshots, recursive=False, wait=True):
+	return _tag_many('release', tag, snapshots, recursive, wait)
+
+# Hold tags of several snapshots with one zfs holds per host, returning
+# {name: [tag, ...]} - the tags are also cached, so holds() on each
+# snapshot can use them
+def holds_many(snapshots):
+	def holds_group(group):
+		base, netloc, paths = group
+		cmd = ['zfs', 'holds', '-H']
+		cmd.extend(paths)
+		return [(_urlupdate(base, path=hold[0]), hold[1]) for hold
+			in process.check_output_iter(cmd, netloc=netloc)]
+
+	snapshots = list(snapshots)
+	generation = cache.props.generation
+	result = dict((name, []) for name in snapshots)
+	for holds in process.pool_map(holds_group, _group_by_host(snapshots)):
+		for name, tag in holds:
+			result.setdefault(name, []).append(tag)
+
+	# cache tuples, so that changes to the lists returned don't reach
+	# the cache
+	for name, tags in result.items():
+		cache.props.put((name, 'holds'), tuple(tags), generation)
+	return result
+
+def _tag_many(action, tag, snapshots, recursive, wait=True):
+	if not wait:
+		return process.call_async(_tag_many,
+			action, tag, list(snapshots), recursive)
+
+	for base, netloc, paths in _group_by_host(snapshots):
+		cmd = ['zfs', action]
+
+		if recursive:
+			cmd.append('-r')
+
+		cmd.append(tag)
+		cmd.extend(paths)
+
+		lzc = None
+		if not recursive:
+			lzc = functools.partial(getattr(_lzc, action), tag, paths)
+
+		_check_call(cmd, netloc,
+			[_urlupdate(base, path=path) for path in paths], lzc=lzc)
+
+# Create several snapshots with one zfs snapshot per pool, so that the
+# snapshots in each pool are taken atomically - where a dataset has more
+# than one snapshot given, they are taken in separate commands
+def snapshot_many(names, recursive=False, props=None):
+	names = list(names)
+	for base, netloc, paths in _group_by_pool(names, True):
+		cmd = ['zfs', 'snapshot']
+
+		if recursive:
+			cmd.append('-r')
+
+		for prop, value in (props or {}).items():
+			cmd.extend(('-o', '%s=%s' % (prop, value)))
+
+		cmd.extend(paths)
+
+		lzc = None
+		if not recursive and not props:
+			lzc = functools.partial(_lzc.snapshot, paths)
+
+		_check_call(cmd, netloc,
+			[_urlupdate(base, path=path) for path in paths], lzc=lzc)
+
+	return [open(name, 'snapshot') for name in names]
+
+# Snapshots requested in this thread within snapshot_batch()
+_batch = threading.local()
+
+# Collect the snapshots requested with ZFSDataset.snapshot() within the
+# block and create them together with snapshot_many() when it ends - the
+# snapshot objects returned within the block don't exist until then, and
+# none are created if the block raises an exception
+@contextlib.contextmanager
+def snapshot_batch():
+	if getattr(_batch, 'snapshots', None) is not None:
+		# nested: the outermost block creates the snapshots
+		yield
+		return
+
+	_batch.snapshots = pending = []
+	try:
+		yield
+	finally:
+		_batch.snapshots = None
+
+	# snapshots with the same options are created together
+	groups = {}
+	keys = []
+	for name, recursive, props in pending:
+		key = (recursive, tuple(sorted((props or {}).items())))
+		if key not in groups:
+			groups[key] = []
+			keys.append(key)
+		groups[key].append(name)
+
+	for key in keys:
+		snapshot_many(groups[key], key[0], dict(key[1]))
 
 class ZFSDataset(object):
+	# datasets may be found in large numbers, so avoid a __dict__ for each
+	__slots__ = ('name', '_url', '__weakref__')
+
 	def __init__(self, name):
 		self.name = name
 		self._url = _urlsplit(name)
@@ -172,13 +611,44 @@ class ZFSDataset(object):
 		return open(parent_name) if parent_name else None
 
 	def filesystems(self):
-		return find(self.name, max_depth=1, types=['filesystem'])[1:]
+		return list(self.filesystems_iter())
 
 	def snapshots(self):
-		return find(self.name, max_depth=1, types=['snapshot'])
+		return list(self.snapshots_iter())
 
 	def children(self):
-		return find(self.name, max_depth=1, types=['all'])[1:]
+		return list(self.children_iter())
+
+	# children listed with one zfs list and grouped by type
+	def children_grouped(self):
+		groups = dict((type, []) for type in _types)
+		for dataset in self.children_iter():
+			groups.setdefault(dataset.type, []).append(dataset)
+		return groups
+
+	# iterators over the datasets above, skipping this dataset itself
+	def filesystems_iter(self):
+		children = self._cached_children()
+		if children is not None:
+			return (d for d in children if d.type == 'filesystem')
+		return itertools.islice(
+			find_iter(self.name, max_depth=1, types=['filesystem']), 1, None)
+
+	def snapshots_iter(self):
+		children = self._cached_children()
+		if children is not None:
+			return (d for d in children if d.type == 'snapshot')
+		return find_iter(self.name, max_depth=1, types=['snapshot'])
+
+	def children_iter(self):
+		return itertools.islice(
+			find_iter(self.name, max_depth=1, types=['all']), 1, None)
+
+	# a cached listing of all children also answers filesystems() and
+	# snapshots(), eg after children_grouped()
+	def _cached_children(self):
+		datasets = cache.props.get((self.name, 1, ('all',)))
+		return None if datasets is None else datasets[1:]
 
 	def clones(self):
 		raise NotImplementedError()
@@ -191,35 +661,36 @@ class ZFSDataset(object):
 	def destroy(self, defer=False, force=False):
 		cmd = ['zfs', 'destroy']
 
-		cmd.append('-v')
+		if _verbose():
+			cmd.append('-v')
 
 		if defer:
 			cmd.append('-d')
 
 		if force:
-			cmd.append('-f')
-			cmd.append('-R')
+			cmd.extend(('-f', '-R'))
 
 		cmd.append(self._url.path)
 
-		process.check_call(cmd, netloc=self._url.netloc)
+		# with force, dependent clones may be anywhere, so forget all
+		# cached results (None stands for all datasets)
+		_check_call(cmd, self._url.netloc, [None if force else self.name])
 
-	def snapshot(self, snapname, recursive=False, props={}):
-		cmd = ['zfs', 'snapshot']
-
-		if recursive:
-			cmd.append('-r')
-
-		for prop, value in props.items():
-			cmd.append('-o')
-			cmd.append(prop + '=' + str(value))
+		# forget objects for the destroyed dataset and those related to it
+		for name in list(_datasets.keys()):
+			if force or cache._related(name, self.name):
+				_datasets.pop(name, None)
 
+	def snapshot(self, snapname, recursive=False, props=None):
 		name = self.name + '@' + snapname
-		url = _urlsplit(name)
-		cmd.append(url.path)
 
-		process.check_call(cmd, netloc=url.netloc)
-		return ZFSSnapshot(name)
+		# within snapshot_batch() the snapshot is created on leaving it
+		pending = getattr(_batch, 'snapshots', None)
+		if pending is not None:
+			pending.append((name, recursive, props))
+			return open(name, 'snapshot')
+
+		return snapshot_many([name], recursive, props)[0]
 
 	# TODO: split force to allow -f, -r and -R to be specified individually
 	def rollback(self, snapname, force=False):
@@ -232,34 +703,38 @@ class ZFSDataset(object):
 	def rename(self, name, recursive=False, force=False):
 		raise NotImplementedError()
 
-	def getprops(self):
-		return findprops(self.name, max_depth=0)
+	def getprops(self, props=('all',)):
+		return findprops(self.name, max_depth=0, props=props)
 
 	def getprop(self, prop):
+		row = cache.props.getprop(self.name, prop)
+		if row is not None:
+			return row
 		return findprops(self.name, max_depth=0, props=[prop])[0]
 
 	def getpropval(self, prop, default=None):
 		value = self.getprop(prop)['value']
 		return default if value == '-' else value
 
-	def setprop(self, prop, value):
-		cmd = ['zfs', 'set']
+	# Forget cached properties of this dataset, eg after it was changed
+	# other than through weir
+	def refresh(self):
+		cache.props.invalidate(self.name)
 
-		cmd.append(prop + '=' + str(value))
-		cmd.append(self._url.path)
+	def setprop(self, prop, value, wait=True):
+		cmd = ['zfs', 'set', '%s=%s' % (prop, value), self._url.path]
 
-		process.check_call(cmd, netloc=self._url.netloc)
+		return _check_call(cmd, self._url.netloc, [self.name], wait)
 
-	def delprop(self, prop, recursive=False):
+	def delprop(self, prop, recursive=False, wait=True):
 		cmd = ['zfs', 'inherit']
 
 		if recursive:
 			cmd.append('-r')
 
-		cmd.append(prop)
-		cmd.append(self._url.path)
+		cmd.extend((prop, self._url.path))
 
-		process.check_call(cmd, netloc=self._url.netloc)
+		return _check_call(cmd, self._url.netloc, [self.name], wait)
 
 	def userspace(self, *args, **kwargs):
 		raise NotImplementedError()
@@ -280,9 +755,13 @@ class ZFSDataset(object):
 		raise NotImplementedError()
 
 class ZFSVolume(ZFSDataset):
-	pass
+	__slots__ = ()
+	type = 'volume'
 
 class ZFSFilesystem(ZFSDataset):
+	__slots__ = ()
+	type = 'filesystem'
+
 	def upgrade(self, *args, **kwargs):
 		raise NotImplementedError()
 
@@ -293,24 +772,37 @@ class ZFSFilesystem(ZFSDataset):
 		raise NotImplementedError()
 
 class ZFSSnapshot(ZFSDataset):
+	__slots__ = ('_snapname', '_parent_name')
+	type = 'snapshot'
+
+	def __init__(self, name):
+		super(ZFSSnapshot, self).__init__(name)
+
+		# snapshot names don't change, so split them once
+		parent_path, _, self._snapname = self._url.path.partition('@')
+		self._parent_name = _urlupdate(name, path=parent_path)
+
 	def snapname(self):
-		_, _, snapname = self._url.path.partition('@')
-		return snapname
+		return self._snapname
 
 	def parent(self):
-		parent_path, _, _ = self._url.path.partition('@')
-		return open(_urlupdate(self.name, path=parent_path))
+		return open(self._parent_name)
 
 	# note: force means create missing parent filesystems
-	def clone(self, name, props={}, force=False):
+	def clone(self, name, props=None, force=False):
 		raise NotImplementedError()
 
+	# note: if file is given the stream is written to it, otherwise an
+	# open file is returned for the caller to read the stream from
 	def send(self, base=None, intermediates=False, replicate=False,
-			properties=False, deduplicate=False):
+			properties=False, deduplicate=False, file=None, verbose=None,
+			buffer_size=1 << 20):
 		cmd = ['zfs', 'send']
 
-		cmd.append('-v')
-		cmd.append('-P')
+		if verbose is None:
+			verbose = _verbose()
+		if verbose:
+			cmd.extend(('-v', '-P'))
 
 		if replicate:
 			cmd.append('-R')
@@ -323,45 +815,35 @@ class ZFSSnapshot(ZFSDataset):
 			base = _urlsplit(base)
 			if base.netloc and base.netloc != self._url.netloc:
 				raise ValueError('snapshots must be on same host')
-			if intermediates:
-				cmd.append('-I')
-			else:
-				cmd.append('-i')
-			cmd.append(base.path)
+			cmd.extend(('-I' if intermediates else '-i', base.path))
 
 		cmd.append(self._url.path)
 
-		return process.popen(cmd, mode='rb', netloc=self._url.netloc)
+		f = process.popen(cmd, mode='rb', netloc=self._url.netloc)
+		process.set_pipe_size(f, buffer_size)
+		if file is None:
+			return f
 
-	def hold(self, tag, recursive=False):
-		cmd = ['zfs', 'hold']
-
-		if recursive:
-			cmd.append('-r')
-
-		cmd.append(tag)
-		cmd.append(self._url.path)
+		try:
+			process.copy(f, file)
+		finally:
+			f.close()
 
-		process.check_call(cmd, netloc=self._url.netloc)
+	def hold(self, tag, recursive=False, wait=True):
+		return hold_many(tag, [self.name], recursive, wait)
 
 	def holds(self):
-		cmd = ['zfs', 'holds']
-
-		cmd.append('-H')
-
-		cmd.append(self._url.path)
-
-		# return hold tag names only
-		return [hold[1] for hold
-			in process.check_output(cmd, netloc=self._url.netloc)]
-
-	def release(self, tag, recursive=False):
-		cmd = ['zfs', 'release']
-
-		if recursive:
-			cmd.append('-r')
-
-		cmd.append(tag)
-		cmd.append(self._url.path)
-
-		process.check_call(cmd, netloc=self._url.netloc)
+		tags = cache.props.get((self.name, 'holds'))
+		if tags is None:
+			tags = holds_many([self.name])[self.name]
+		return list(tags)
+
+	def release(self, tag, recursive=False, wait=True):
+		return release_many(tag, [self.name], recursive, wait)
+
+# Dataset classes by zfs type, for open()
+_types = {
+	'volume': ZFSVolume,
+	'filesystem': ZFSFilesystem,
+	'snapshot': ZFSSnapshot,
+}